@@ -1,76 +1,166 @@
 import os
 import asyncio
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, F, types
 from aiogram.filters import Command
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from dotenv import load_dotenv
-from database import init_db, add_search_history, get_search_history, update_movie_stats, get_user_stats
-from movie_search import MovieSearcher
+from cachetools import TTLCache
+
+# .env должен быть загружен до импорта database: там читается DATABASE_URL
+load_dotenv(dotenv_path=".env", override=True)
+
+from database import init_db, record_view, get_search_history, update_movie_stats, get_user_stats
+from movie_search import MovieSearcher, MovieInfo
 import logging
-from datetime import datetime
+import logging.handlers
+import queue
+import atexit
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
 import json
 import random
 
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(f'bot_{datetime.now().strftime("%Y%m%d")}.log'),
-        logging.StreamHandler()
-    ]
-)
+try:
+    import uvloop
+except ImportError:  # uvloop не поддерживает Windows
+    uvloop = None
+
+
+# Запись логов идет в отдельном потоке, чтобы не блокировать event loop
+log_formatter = logging.Formatter(
+    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+log_handlers = [
+    logging.FileHandler(f'bot_{datetime.now().strftime("%Y%m%d")}.log'),
+    logging.StreamHandler()
+]
+for handler in log_handlers:
+    handler.setFormatter(log_formatter)
+
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(log_queue, *log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
 logger = logging.getLogger(__name__)
-
-load_dotenv(dotenv_path=".env", override=True)
-
+# Повторная строка в логе означает, что обработчики регистрируются дважды
+logger.info(f"Bot module loaded from {__file__}")
 
 bot = Bot(token=os.environ['TELEGRAM_TOKEN_NEW'])
 dp = Dispatcher()
 
 movie_searcher = MovieSearcher()
 
-# Dictionary to store movie data temporarily
-movie_cache = {}
+# Результаты последнего поиска пользователя (для навигации по кнопкам)
+movie_cache = TTLCache(maxsize=10_000, ttl=900)
+
+
+@dataclass(slots=True)
+class GameState:
+    """Состояние игры "Угадай фильм" одного пользователя"""
+    score: int = 0
+    total_questions: int = 0
+    correct_movie: Optional[MovieInfo] = None
+    options: List[MovieInfo] = field(default_factory=list)
+    pool: List[MovieInfo] = field(default_factory=list)
+    last_message_id: Optional[int] = None
+
+
+# Состояние текущей игры пользователя
+game_cache = TTLCache(maxsize=10_000, ttl=1800)
+
+# Время в истории показывается по Москве (UTC+3, без перехода на летнее время)
+MOSCOW_TZ = timezone(timedelta(hours=3))
+
+# Количество вариантов ответа в вопросе и размер пула фильмов на одну игру
+GAME_OPTIONS_COUNT = 4
+GAME_POOL_SIZE = 20
+
+# Фоновые записи в БД; ссылки храним, чтобы задачи не были собраны GC
+background_tasks = set()
+
+# Недавно показанные пары (user_id, movie_id): повторный показ в течение
+# ttl секунд (например, листание кнопками туда и обратно) не засчитывается
+recent_views = TTLCache(maxsize=10_000, ttl=30)
+
+START_TEXT = (
+    "Привет! Я бот для поиска фильмов. 🎬\n\n"
+    "Просто напиши название фильма, и я найду информацию о нем!\n"
+    "Также доступны команды:\n"
+    "/help - показать справку\n"
+    "/history - история поиска\n"
+    "/stats - статистика просмотров\n"
+    "/game - сыграть в игру 'Угадай фильм'"
+)
+
+HELP_TEXT = (
+    "Я умею искать фильмы! 🎥\n\n"
+    "Просто напиши название фильма, и я найду информацию о нем.\n"
+    "Я покажу:\n"
+    "• Название и описание\n"
+    "• Рейтинг\n"
+    "• Постер\n"
+    "• Жанры и страны\n"
+    "• Длительность\n"
+    "• Ссылки для просмотра\n\n"
+    "Команды:\n"
+    "/start - начать работу\n"
+    "/help - показать это сообщение\n"
+    "/history - история поиска\n"
+    "/stats - статистика просмотров\n"
+    "/game - сыграть в игру 'Угадай фильм'"
+)
+
+# Кнопка для получения другого случайного фильма
+RANDOM_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[[
+    InlineKeyboardButton(
+        text="🎲 Другой случайный фильм",
+        callback_data="random_movie"
+    )
+]])
+
+
+def _on_background_task_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error("Error in background task", exc_info=task.exception())
 
-# Dictionary to store game data
-game_cache = {}
+
+def run_in_background(coro):
+    """Запускает запись в БД, не задерживая ответ пользователю"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+
+
+def format_timestamp(timestamp: datetime) -> str:
+    """Переводит время из БД (UTC) в московское"""
+    moscow_time = timestamp.replace(tzinfo=timezone.utc).astimezone(MOSCOW_TZ)
+    return moscow_time.strftime('%d.%m.%Y %H:%M')
+
+
+def count_movie_view(user_id: int, movie: MovieInfo):
+    """Увеличивает счетчик показов фильма, пропуская частые повторы"""
+    key = (user_id, movie.movie_id)
+    if key in recent_views:
+        return
+    recent_views[key] = True
+    run_in_background(update_movie_stats(user_id, movie.movie_id, movie.title))
 
 
 @dp.message(Command("start"))
 async def cmd_start(message: Message):
     logger.info(f"User {message.from_user.id} started the bot")
-    await message.answer(
-        "Привет! Я бот для поиска фильмов. 🎬\n\n"
-        "Просто напиши название фильма, и я найду информацию о нем!\n"
-        "Также доступны команды:\n"
-        "/help - показать справку\n"
-        "/history - история поиска\n"
-        "/stats - статистика просмотров\n"
-        "/game - сыграть в игру 'Угадай фильм'"
-    )
+    await message.answer(START_TEXT)
 
 
 @dp.message(Command("help"))
 async def cmd_help(message: Message):
     logger.info(f"User {message.from_user.id} requested help")
-    await message.answer(
-        "Я умею искать фильмы! 🎥\n\n"
-        "Просто напиши название фильма, и я найду информацию о нем.\n"
-        "Я покажу:\n"
-        "• Название и описание\n"
-        "• Рейтинг\n"
-        "• Постер\n"
-        "• Жанры и страны\n"
-        "• Длительность\n"
-        "• Ссылки для просмотра\n\n"
-        "Команды:\n"
-        "/start - начать работу\n"
-        "/help - показать это сообщение\n"
-        "/history - история поиска\n"
-        "/stats - статистика просмотров\n"
-        "/game - сыграть в игру 'Угадай фильм'"
-    )
+    await message.answer(HELP_TEXT)
 
 
 @dp.message(Command("history"))
@@ -82,13 +172,16 @@ async def cmd_history(message: Message):
         await message.answer("У вас пока нет истории поиска.")
         return
 
-    response = "📜 Ваша история поиска:\n\n"
+    lines = ["📜 Ваша история поиска:", ""]
     for item in history:
-        response += f"• {item.movie_title}\n"
-        response += f"  Поисковый запрос: {item.query}\n"
-        response += f"  Дата: {item.timestamp.strftime('%d.%m.%Y %H:%M')}\n\n"
-
-    await message.answer(response)
+        lines.extend([
+            f"• {item.movie_title}",
+            f"  Поисковый запрос: {item.query}",
+            f"  Дата: {format_timestamp(item.timestamp)}",
+            "",
+        ])
+
+    await message.answer("\n".join(lines))
     logger.info(f"Sent search history to user {message.from_user.id}")
 
 
@@ -101,12 +194,15 @@ async def cmd_stats(message: Message):
         await message.answer("У вас пока нет статистики просмотров.")
         return
 
-    response = "📊 Ваша статистика просмотров:\n\n"
+    lines = ["📊 Ваша статистика просмотров:", ""]
     for stat in stats:
-        response += f"• {stat.movie_title}\n"
-        response += f"  Показано раз: {stat.times_shown}\n\n"
+        lines.extend([
+            f"• {stat.movie_title}",
+            f"  Показано раз: {stat.times_shown}",
+            "",
+        ])
 
-    await message.answer(response)
+    await message.answer("\n".join(lines))
     logger.info(f"Sent viewing stats to user {message.from_user.id}")
 
 
@@ -117,10 +213,7 @@ async def cmd_game(message: Message):
 
     try:
         # Инициализируем/сбрасываем кэш для новой игры
-        game_cache[user_id] = {
-            'score': 0,
-            'total_questions': 0
-        }
+        game_cache[user_id] = GameState()
 
         # Получаем новый вопрос
         text, keyboard = await prepare_new_question(user_id)
@@ -137,7 +230,7 @@ async def cmd_game(message: Message):
             await message.answer("🎮 Новая игра началась!")
             sent_msg = await message.answer(text, reply_markup=keyboard)
             # Сохраняем ID последнего игрового сообщения
-            game_cache[user_id]['last_message_id'] = sent_msg.message_id
+            game_cache[user_id].last_message_id = sent_msg.message_id
 
     except Exception as e:
         logger.error(f"Error in cmd_game: {str(e)}", exc_info=True)
@@ -157,42 +250,21 @@ async def cmd_random(message: Message):
             return
 
         movie = movies[0]
-        await update_movie_stats(message.from_user.id, movie.movie_id, movie.title)
-
-        response = f"🎬 {movie.title}\n\n"
-        response += f"📝 {movie.overview}\n\n"
-        response += f"⭐ Рейтинг: {movie.rating}/10\n"
-        response += f"📅 Год выпуска: {movie.release_date}\n"
-        response += f"⏱ Длительность: {movie.film_length}\n\n"
-
-        if movie.genres:
-            response += f"🎭 Жанры: {', '.join(movie.genres)}\n"
-        if movie.countries:
-            response += f"🌍 Страны: {', '.join(movie.countries)}\n\n"
-
-        response += "🔗 Ссылки для просмотра:\n"
-        for link in movie.viewing_links:
-            response += f"• {link}\n"
-
-        # Create button for getting another random movie
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(
-                text="🎲 Другой случайный фильм",
-                callback_data="random_movie"
-            )
-        ]])
+        run_in_background(update_movie_stats(message.from_user.id, movie.movie_id, movie.title))
+
+        response = movie.formatted
 
         if movie.poster_url:
             await searching_msg.delete()
             await message.answer_photo(
                 photo=movie.poster_url,
                 caption=response,
-                reply_markup=keyboard
+                reply_markup=RANDOM_KEYBOARD
             )
         else:
             await searching_msg.edit_text(
                 text=response,
-                reply_markup=keyboard
+                reply_markup=RANDOM_KEYBOARD
             )
 
         logger.info(f"Sent random movie to user {message.from_user.id}")
@@ -203,7 +275,7 @@ async def cmd_random(message: Message):
         await searching_msg.edit_text("😔 Произошла ошибка при поиске случайного фильма. Попробуйте позже.")
 
 
-@dp.callback_query(lambda c: c.data == "random_movie")
+@dp.callback_query(F.data == "random_movie")
 async def process_random_callback(callback_query: CallbackQuery):
     try:
         # Отправляем сообщение о поиске
@@ -220,30 +292,9 @@ async def process_random_callback(callback_query: CallbackQuery):
             return
 
         movie = movies[0]
-        await update_movie_stats(callback_query.from_user.id, movie.movie_id, movie.title)
-
-        response = f"🎬 {movie.title}\n\n"
-        response += f"📝 {movie.overview}\n\n"
-        response += f"⭐ Рейтинг: {movie.rating}/10\n"
-        response += f"📅 Год выпуска: {movie.release_date}\n"
-        response += f"⏱ Длительность: {movie.film_length}\n\n"
-
-        if movie.genres:
-            response += f"🎭 Жанры: {', '.join(movie.genres)}\n"
-        if movie.countries:
-            response += f"🌍 Страны: {', '.join(movie.countries)}\n\n"
-
-        response += "🔗 Ссылки для просмотра:\n"
-        for link in movie.viewing_links:
-            response += f"• {link}\n"
-
-        # Create button for getting another random movie
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(
-                text="🎲 Другой случайный фильм",
-                callback_data="random_movie"
-            )
-        ]])
+        run_in_background(update_movie_stats(callback_query.from_user.id, movie.movie_id, movie.title))
+
+        response = movie.formatted
 
         # Update the message with new movie info
         if movie.poster_url:
@@ -252,12 +303,12 @@ async def process_random_callback(callback_query: CallbackQuery):
                     media=movie.poster_url,
                     caption=response
                 ),
-                reply_markup=keyboard
+                reply_markup=RANDOM_KEYBOARD
             )
         else:
             await callback_query.message.edit_text(
                 text=response,
-                reply_markup=keyboard
+                reply_markup=RANDOM_KEYBOARD
             )
 
         await callback_query.answer()
@@ -268,7 +319,7 @@ async def process_random_callback(callback_query: CallbackQuery):
         await callback_query.answer("Произошла ошибка при поиске случайного фильма")
 
 
-@dp.callback_query(lambda c: c.data.startswith('movie_'))
+@dp.callback_query(F.data.startswith('movie_'))
 async def process_movie_callback(callback_query: CallbackQuery):
     try:
         # Extract movie index from callback data
@@ -276,32 +327,19 @@ async def process_movie_callback(callback_query: CallbackQuery):
         user_id = callback_query.from_user.id
 
         # Get movie data from cache
-        if user_id not in movie_cache:
+        movies = movie_cache.get(user_id)
+        if movies is None:
             await callback_query.answer("Время ожидания истекло. Пожалуйста, выполните поиск снова.")
             return
 
-        movies = movie_cache[user_id]
         if movie_index >= len(movies):
             await callback_query.answer("Фильм не найден")
             return
 
         movie = movies[movie_index]
-        await update_movie_stats(user_id, movie.movie_id, movie.title)
-
-        response = f"🎬 {movie.title}\n\n"
-        response += f"📝 {movie.overview}\n\n"
-        response += f"⭐ Рейтинг: {movie.rating}/10\n"
-        response += f"📅 Год выпуска: {movie.release_date}\n"
-        response += f"⏱ Длительность: {movie.film_length}\n\n"
+        count_movie_view(user_id, movie)
 
-        if movie.genres:
-            response += f"🎭 Жанры: {', '.join(movie.genres)}\n"
-        if movie.countries:
-            response += f"🌍 Страны: {', '.join(movie.countries)}\n\n"
-
-        response += "🔗 Ссылки для просмотра:\n"
-        for link in movie.viewing_links:
-            response += f"• {link}\n"
+        response = movie.formatted
 
         # Create navigation buttons for adjacent movies
         buttons = []
@@ -372,24 +410,11 @@ async def handle_movie_search(message: Message):
 
         # Get first movie
         movie = movies[0]
-        await update_movie_stats(message.from_user.id, movie.movie_id, movie.title)
-        await add_search_history(message.from_user.id, message.text, movie.title, movie.movie_id)
-
-        # Create response for first movie
-        response = f"🎬 {movie.title}\n\n"
-        response += f"📝 {movie.overview}\n\n"
-        response += f"⭐ Рейтинг: {movie.rating}/10\n"
-        response += f"📅 Год выпуска: {movie.release_date}\n"
-        response += f"⏱ Длительность: {movie.film_length}\n\n"
-
-        if movie.genres:
-            response += f"🎭 Жанры: {', '.join(movie.genres)}\n"
-        if movie.countries:
-            response += f"🌍 Страны: {', '.join(movie.countries)}\n\n"
+        recent_views[(message.from_user.id, movie.movie_id)] = True
+        run_in_background(record_view(
+            message.from_user.id, message.text, [(movie.movie_id, movie.title)]))
 
-        response += "🔗 Ссылки для просмотра:\n"
-        for link in movie.viewing_links:
-            response += f"• {link}\n"
+        response = movie.formatted
 
         # Create navigation buttons for adjacent movies
         buttons = []
@@ -431,7 +456,7 @@ async def handle_movie_search(message: Message):
         await searching_msg.edit_text("😔 Произошла ошибка при поиске фильма. Попробуйте позже.")
 
 
-@dp.callback_query(lambda c: c.data == "next_question")
+@dp.callback_query(F.data == "next_question")
 async def process_next_question(callback_query: CallbackQuery):
     try:
         user_id = callback_query.from_user.id
@@ -453,11 +478,11 @@ async def process_next_question(callback_query: CallbackQuery):
 async def prepare_new_question(user_id: int):
     try:
         # Проверяем, не достигнут ли лимит вопросов
-        game_data = game_cache.get(user_id, {'score': 0, 'total_questions': 0})
-        if game_data['total_questions'] >= 5:
+        game_data = game_cache.get(user_id) or GameState()
+        if game_data.total_questions >= 5:
             # Формируем итоговый результат
-            final_score = game_data['score']
-            total_questions = game_data['total_questions']
+            final_score = game_data.score
+            total_questions = game_data.total_questions
             percentage = (final_score / total_questions) * 100
 
             result_text = (
@@ -485,38 +510,42 @@ async def prepare_new_question(user_id: int):
             ]])
 
             # Очищаем кэш игры
-            if user_id in game_cache:
-                del game_cache[user_id]
+            game_cache.pop(user_id, None)
 
             return result_text, keyboard
 
-        logger.info("Getting random movies for game...")
-        movies = await movie_searcher.get_random_movies_for_game(4)
-        if not movies:
-            logger.error("No movies found for game")
-            return "😕 К сожалению, я не смог подготовить игру. Попробуйте позже.", None
+        # Фильмы загружаются один раз на игру, вопросы собираются из этого пула
+        pool = game_data.pool
+        if len(pool) < GAME_OPTIONS_COUNT:
+            logger.info("Getting random movies for game...")
+            pool = await movie_searcher.get_random_movies_for_game(GAME_POOL_SIZE)
+            if len(pool) < GAME_OPTIONS_COUNT:
+                logger.error("No movies found for game")
+                return "😕 К сожалению, я не смог подготовить игру. Попробуйте позже.", None
+            game_data.pool = pool
+
+        movies = random.sample(pool, GAME_OPTIONS_COUNT)
 
-        # Выбираем новый правильный фильм
+        # Выбираем новый правильный фильм и убираем его из пула, чтобы он не повторялся
         correct_movie = random.choice(movies)
+        pool.remove(correct_movie)
         logger.info(f"Selected correct movie: {correct_movie.title}")
 
         # Обновляем кэш
-        game_data.update({
-            'correct_movie': correct_movie,
-            'options': [m for m in movies if m != correct_movie]
-        })
+        game_data.correct_movie = correct_movie
+        game_data.options = [m for m in movies if m != correct_movie]
         game_cache[user_id] = game_data
 
         # Формируем сообщение
         response = (
             "🎮 Угадай фильм!\n\n"
             f"📝 {movie_searcher.get_movie_description_for_game(correct_movie)}\n\n"
-            f"Вопрос {game_data['total_questions'] + 1} из 5\n"
+            f"Вопрос {game_data.total_questions + 1} из 5\n"
             "Выберите правильный ответ:"
         )
 
         # Создаем кнопки
-        all_movies = [correct_movie] + game_data['options']
+        all_movies = [correct_movie] + game_data.options
         random.shuffle(all_movies)
         buttons = [
             [InlineKeyboardButton(
@@ -531,17 +560,14 @@ async def prepare_new_question(user_id: int):
         return "😔 Произошла ошибка при подготовке вопроса", None
 
 
-@dp.callback_query(lambda c: c.data == "new_game")
+@dp.callback_query(F.data == "new_game")
 async def process_new_game(callback_query: CallbackQuery):
     try:
         user_id = callback_query.from_user.id
         logger.info(f"Starting new game for user {user_id}")
 
         # Инициализируем новый кэш игры
-        game_cache[user_id] = {
-            'score': 0,
-            'total_questions': 0
-        }
+        game_cache[user_id] = GameState()
 
         # Подготавливаем первый вопрос
         text, keyboard = await prepare_new_question(user_id)
@@ -555,7 +581,7 @@ async def process_new_game(callback_query: CallbackQuery):
         await callback_query.answer("Произошла ошибка при запуске новой игры")
 
 
-@dp.callback_query(lambda c: c.data.startswith('game_'))
+@dp.callback_query(F.data.startswith('game_'))
 async def process_game_callback(callback_query: CallbackQuery):
     try:
         user_id = callback_query.from_user.id
@@ -563,31 +589,31 @@ async def process_game_callback(callback_query: CallbackQuery):
 
         # Проверка наличия активной игры
         game_data = game_cache.get(user_id)
-        if not game_data or 'correct_movie' not in game_data:
+        if not game_data or game_data.correct_movie is None:
             await callback_query.answer("Игра закончилась. Начните новую игру командой /game")
             return
 
         # Определение выбранного и правильного ответов
         selected_movie_id = callback_query.data.split('_')[1]
-        correct_movie = game_data['correct_movie']
+        correct_movie = game_data.correct_movie
         is_correct = selected_movie_id == correct_movie.movie_id
 
         # Обновление статистики
-        game_data['total_questions'] += 1
+        game_data.total_questions += 1
         if is_correct:
-            game_data['score'] += 1
+            game_data.score += 1
 
         # Формирование результата
         result_text = ("✅ Правильно!" if is_correct
                        else f"❌ Неправильно! Правильный ответ: {correct_movie.title}")
 
         # Удаление правильного ответа из кэша
-        del game_data['correct_movie']
+        game_data.correct_movie = None
 
         # Редактирование сообщения с результатом
         await callback_query.message.edit_text(
             f"{result_text}\n\n"
-            f"Ваш счет: {game_data['score']}/{game_data['total_questions']}\n\n"
+            f"Ваш счет: {game_data.score}/{game_data.total_questions}\n\n"
             "Нажмите кнопку ниже, чтобы продолжить игру:",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[[
                 InlineKeyboardButton(
@@ -607,7 +633,16 @@ async def process_game_callback(callback_query: CallbackQuery):
 async def main():
     await init_db()
 
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # Дожидаемся незавершенных записей в БД перед выходом
+        if background_tasks:
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+        await movie_searcher.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
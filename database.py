@@ -1,10 +1,47 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import select
-from datetime import datetime, timedelta
-from typing import List, Optional
+from sqlalchemy import (BigInteger, Index, Row, delete, event, func, insert,
+                        inspect, select, update)
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from datetime import datetime
+from typing import List, Optional, Tuple
+import os
+
+DATABASE_URL = os.getenv('DATABASE_URL') or 'sqlite+aiosqlite:///cinema_bot.db'
+
+if DATABASE_URL.startswith('sqlite'):
+    engine = create_async_engine(DATABASE_URL)
+else:
+    # format_timestamp считает время в БД UTC, а now() в PostgreSQL
+    # возвращает время в часовом поясе сессии
+    connect_args = {}
+    if DATABASE_URL.startswith('postgresql+asyncpg'):
+        connect_args = {"server_settings": {"timezone": "UTC"}}
+    engine = create_async_engine(
+        DATABASE_URL,
+        pool_size=10,
+        max_overflow=20,
+        pool_pre_ping=True,
+        connect_args=connect_args
+    )
+async_session = async_sessionmaker(engine, expire_on_commit=False)
+
+# INSERT ... ON CONFLICT есть и в SQLite, и в PostgreSQL, но строится разными диалектами
+_dialect_insert = postgresql_insert if engine.dialect.name == 'postgresql' else sqlite_insert
+
+
+def _set_sqlite_pragmas(dbapi_conn, connection_record):
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
 
-engine = create_async_engine('sqlite+aiosqlite:///cinema_bot.db')
+
+if engine.dialect.name == 'sqlite':
+    event.listen(engine.sync_engine, "connect", _set_sqlite_pragmas)
 
 
 class Base(DeclarativeBase):
@@ -13,12 +50,17 @@ class Base(DeclarativeBase):
 
 class SearchHistory(Base):
     __tablename__ = 'search_history'
+    __table_args__ = (
+        Index('ix_search_history_user_timestamp', 'user_id', 'timestamp'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id: Mapped[int]
+    # ID пользователей Telegram не помещаются в 32-битный INTEGER
+    user_id: Mapped[int] = mapped_column(BigInteger)
     query: Mapped[str]
+    # Время в UTC; default нужен для таблиц, созданных до server_default
     timestamp: Mapped[datetime] = mapped_column(
-        default=lambda: datetime.utcnow() + timedelta(hours=3)
+        default=func.now(), server_default=func.now()
     )
     movie_title: Mapped[str]
     movie_id: Mapped[str]
@@ -26,70 +68,129 @@ class SearchHistory(Base):
 
 class MovieStats(Base):
     __tablename__ = 'movie_stats'
+    __table_args__ = (
+        Index('ix_movie_stats_user_movie', 'user_id', 'movie_id', unique=True),
+        Index('ix_movie_stats_user_times_shown', 'user_id', 'times_shown'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id: Mapped[int]
+    # ID пользователей Telegram не помещаются в 32-битный INTEGER
+    user_id: Mapped[int] = mapped_column(BigInteger)
     movie_id: Mapped[str]
     movie_title: Mapped[str]
     times_shown: Mapped[int] = mapped_column(default=1)
 
 
+def _merge_duplicate_movie_stats(conn):
+    # Старый select-then-insert при параллельных апдейтах мог записать
+    # одну пару (user_id, movie_id) несколько раз, и уникальный индекс
+    # на такой таблице не создастся. Сливаем дубли в строку с минимальным id
+    existing = {index['name'] for index in inspect(conn).get_indexes('movie_stats')}
+    if 'ix_movie_stats_user_movie' in existing:
+        return
+    duplicates = conn.execute(
+        select(
+            MovieStats.user_id,
+            MovieStats.movie_id,
+            func.min(MovieStats.id),
+            func.sum(MovieStats.times_shown)
+        )
+        .group_by(MovieStats.user_id, MovieStats.movie_id)
+        .having(func.count() > 1)
+    ).all()
+    for user_id, movie_id, keep_id, times_shown in duplicates:
+        conn.execute(
+            update(MovieStats)
+            .where(MovieStats.id == keep_id)
+            .values(times_shown=times_shown)
+        )
+        conn.execute(
+            delete(MovieStats)
+            .where(MovieStats.user_id == user_id,
+                   MovieStats.movie_id == movie_id,
+                   MovieStats.id != keep_id)
+        )
+
+
+def _create_missing_indexes(conn):
+    # create_all не добавляет индексы в уже существующие таблицы
+    _merge_duplicate_movie_stats(conn)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_create_missing_indexes)
 
 
-async def add_search_history(user_id: int, query: str, movie_title: str, movie_id: str):
-    async with AsyncSession(engine) as session:
-        history = SearchHistory(
-            user_id=user_id,
-            query=query,
-            movie_title=movie_title,
-            movie_id=movie_id
-        )
-        session.add(history)
-        await session.commit()
-
-
-async def get_search_history(user_id: int) -> List[SearchHistory]:
-    async with AsyncSession(engine) as session:
+async def get_search_history(user_id: int) -> List[Row]:
+    async with async_session() as session:
         result = await session.execute(
-            select(SearchHistory)
+            select(
+                SearchHistory.movie_title,
+                SearchHistory.query,
+                SearchHistory.timestamp
+            )
             .where(SearchHistory.user_id == user_id)
-            .order_by(SearchHistory.timestamp.desc())
+            .order_by(SearchHistory.timestamp.desc(), SearchHistory.id.desc())
             .limit(10)
         )
-        return result.scalars().all()
+        return result.all()
+
+
+def _movie_stats_upsert():
+    stmt = _dialect_insert(MovieStats)
+    return stmt.on_conflict_do_update(
+        index_elements=[MovieStats.user_id, MovieStats.movie_id],
+        set_={'times_shown': MovieStats.times_shown + 1}
+    )
 
 
 async def update_movie_stats(user_id: int, movie_id: str, movie_title: str):
-    async with AsyncSession(engine) as session:
-        result = await session.execute(
-            select(MovieStats)
-            .where(MovieStats.user_id == user_id)
-            .where(MovieStats.movie_id == movie_id)
-        )
-        stats = result.scalar_one_or_none()
-
-        if stats:
-            stats.times_shown += 1
-        else:
-            stats = MovieStats(
-                user_id=user_id,
-                movie_id=movie_id,
-                movie_title=movie_title
-            )
-            session.add(stats)
+    async with async_session() as session:
+        await session.execute(_movie_stats_upsert(), [{
+            'user_id': user_id,
+            'movie_id': movie_id,
+            'movie_title': movie_title,
+            'times_shown': 1
+        }])
+        await session.commit()
+
 
+async def record_view(user_id: int, query: str, movies: List[Tuple[str, str]]):
+    """Сохраняет показанные фильмы (пары movie_id, movie_title) в историю
+    и статистику одной транзакцией"""
+    if not movies:
+        return
+
+    history_rows = [{
+        'user_id': user_id,
+        'query': query,
+        'movie_id': movie_id,
+        'movie_title': movie_title
+    } for movie_id, movie_title in movies]
+    stats_rows = [{
+        'user_id': user_id,
+        'movie_id': movie_id,
+        'movie_title': movie_title,
+        'times_shown': 1
+    } for movie_id, movie_title in movies]
+
+    async with async_session() as session:
+        await session.execute(insert(SearchHistory), history_rows)
+        await session.execute(_movie_stats_upsert(), stats_rows)
         await session.commit()
 
 
-async def get_user_stats(user_id: int) -> List[MovieStats]:
-    async with AsyncSession(engine) as session:
+async def get_user_stats(user_id: int) -> List[Row]:
+    async with async_session() as session:
         result = await session.execute(
-            select(MovieStats)
+            select(MovieStats.movie_title, MovieStats.times_shown)
             .where(MovieStats.user_id == user_id)
             .order_by(MovieStats.times_shown.desc())
             .limit(10)
         )
-        return result.scalars().all()
+        return result.all()
@@ -1,15 +1,26 @@
 import aiohttp
+import asyncio
+import orjson
 import os
-from typing import List, Dict, Optional
-from dataclasses import dataclass
-from random import randint, choice, sample, random, shuffle
+import re
+from typing import List, Dict, Optional, Tuple
+from dataclasses import dataclass, field, fields
+from functools import lru_cache
+from random import choice, sample
 import logging
-from datetime import datetime
+import time
+from cachetools import TTLCache
 
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+@lru_cache(maxsize=1024)
+def _title_pattern(title: str) -> re.Pattern:
+    """Скомпилированный шаблон названия фильма как отдельного слова"""
+    return re.compile(r'(?<!\w)' + re.escape(title) + r'(?!\w)', re.IGNORECASE)
+
+
+@dataclass(slots=True, frozen=True)
 class MovieInfo:
     title: str
     overview: str
@@ -17,10 +28,54 @@ class MovieInfo:
     poster_url: str
     release_date: str
     movie_id: str
-    viewing_links: List[str]
-    genres: List[str]
-    countries: List[str]
+    genres: Tuple[str, ...]
+    countries: Tuple[str, ...]
     film_length: str
+    _formatted: Optional[str] = field(
+        default=None, init=False, repr=False, compare=False)
+
+    def to_dict(self) -> Dict:
+        return {f.name: getattr(self, f.name) for f in fields(self) if f.init}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'MovieInfo':
+        kwargs = {f.name: data[f.name] for f in fields(cls) if f.init}
+        # В JSON кортежи превращаются в списки
+        kwargs['genres'] = tuple(kwargs['genres'])
+        kwargs['countries'] = tuple(kwargs['countries'])
+        return cls(**kwargs)
+
+    @property
+    def viewing_links(self) -> Tuple[str, ...]:
+        return (f"https://www.kinopoisk.vip/film/{self.movie_id}/",)
+
+    @property
+    def formatted(self) -> str:
+        """Текст карточки фильма для отправки пользователю"""
+        if self._formatted is None:
+            # Экземпляр неизменяемый, поэтому кэшируем через object.__setattr__
+            object.__setattr__(self, '_formatted', self._render())
+        return self._formatted
+
+    def _render(self) -> str:
+        lines = [
+            f"🎬 {self.title}",
+            "",
+            f"📝 {self.overview}",
+            "",
+            f"⭐ Рейтинг: {self.rating}/10",
+            f"📅 Год выпуска: {self.release_date}",
+            f"⏱ Длительность: {self.film_length}",
+            "",
+        ]
+        if self.genres:
+            lines.append(f"🎭 Жанры: {', '.join(self.genres)}")
+        if self.countries:
+            lines.extend([f"🌍 Страны: {', '.join(self.countries)}", ""])
+
+        lines.append("🔗 Ссылки для просмотра:")
+        lines.extend(f"• {link}" for link in self.viewing_links)
+        return "\n".join(lines)
 
 
 class MovieSearcher:
@@ -30,99 +85,236 @@ class MovieSearcher:
         self.movie_url = f"https://kinopoiskapiunofficial.tech/api/v2.2/films"
         self.top250_url = f"https://kinopoiskapiunofficial.tech/api/v2.2/films/top"
         self._top250_cache = None
+        self._top250_details_cache: Optional[List[MovieInfo]] = None
         self._cache_timestamp = None
         self._cache_duration = 3600
+        self._retry_interval = 300
+        self._refresh_lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._search_cache = TTLCache(maxsize=2048, ttl=3600)
+        self._details_cache = TTLCache(maxsize=2000, ttl=24 * 3600)
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Ограничение одновременных запросов к API Кинопоиска
+        self._semaphore = asyncio.Semaphore(10)
+        # Файл с кэшем топ-250, чтобы не загружать его заново после перезапуска
+        self._cache_path = os.getenv('TOP250_CACHE_PATH', 'top250_cache.json')
+        self._load_top250_from_disk()
+
+    def _load_top250_from_disk(self) -> None:
+        """Восстанавливает кэш топ-250 из файла, если он еще актуален"""
+        try:
+            with open(self._cache_path, 'rb') as f:
+                blob = orjson.loads(f.read())
+            age = time.time() - blob['ts']
+            if not 0 <= age <= self._cache_duration:
+                return
+            films = blob['films']
+            details = [MovieInfo.from_dict(movie) for movie in blob['details']]
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"Error loading top 250 cache from disk: {str(e)}")
+            return
+
+        self._top250_cache = films
+        self._top250_details_cache = details
+        for movie_info in details:
+            self._details_cache[int(movie_info.movie_id)] = movie_info
+        # Возраст кэша переносим на монотонные часы текущего процесса
+        self._cache_timestamp = time.monotonic() - age
+        logger.info(f"Loaded {len(films)} top 250 movies from {self._cache_path}")
+
+    def _save_top250_to_disk(self) -> None:
+        """Атомарно записывает кэш топ-250 в файл"""
+        blob = {
+            'ts': time.time(),
+            'films': self._top250_cache,
+            'details': [movie.to_dict() for movie in self._top250_details_cache]
+        }
+        tmp_path = self._cache_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(blob))
+        os.replace(tmp_path, self._cache_path)
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую HTTP-сессию, создавая ее при первом обращении"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                headers={
+                    'X-API-KEY': self.api_key,
+                    'Accept': 'application/json',
+                    # Ответы API хорошо сжимаются, aiohttp распаковывает их сам
+                    'Accept-Encoding': 'gzip, deflate'
+                },
+                auto_decompress=True,
+                connector=aiohttp.TCPConnector(
+                    limit=20, ttl_dns_cache=300, keepalive_timeout=60)
+            )
+        return self._session
+
+    async def close(self) -> None:
+        """Закрывает HTTP-сессию, вызывается при остановке бота"""
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def _fetch_top250_page(self, session: aiohttp.ClientSession, page: int) -> List[Dict]:
+        """Получает одну страницу топ-250 фильмов"""
+        params = {
+            'type': 'TOP_250_BEST_FILMS',
+            'page': page
+        }
+
+        async with session.get(self.top250_url, params=params) as response:
+            if response.status != 200:
+                logger.error(
+                    f"Error getting top movies page {page}: {response.status}")
+                return []
+
+            data = orjson.loads(await response.read())
+            if not data or 'films' not in data:
+                logger.error(
+                    f"Invalid response format for page {page}")
+                return []
+
+            movies = data.get('films', [])
+            if not movies:
+                logger.error(f"No movies found on page {page}")
+                return []
+
+            logger.debug("Got %d movies from page %d", len(movies), page)
+            return movies
 
     async def _fetch_top250_from_api(self) -> List[Dict]:
         """Получает список топ-250 фильмов напрямую из API"""
-        async with aiohttp.ClientSession() as session:
-            headers = {
-                'X-API-KEY': self.api_key,
-                'Content-Type': 'application/json'
-            }
+        session = await self._get_session()
+
+        try:
+            # Кинопоиск API возвращает по 20 фильмов на страницу, страницы
+            # запрашиваются параллельно
+            pages = await asyncio.gather(
+                *(self._fetch_top250_page(session, page)
+                  for page in range(1, 14)),  # 13 страниц * 20 фильмов = 250 фильмов
+                return_exceptions=True)
 
             all_movies = []
-            try:
-                # Кинопоиск API возвращает по 20 фильмов на страницу
-                for page in range(1, 13):  # 13 страниц * 20 фильмов = 250 фильмов
-                    params = {
-                        'type': 'TOP_250_BEST_FILMS',
-                        'page': page
-                    }
-
-                    async with session.get(self.top250_url, headers=headers, params=params) as response:
-                        if response.status != 200:
-                            logger.error(
-                                f"Error getting top movies page {page}: {response.status}")
-                            continue
-
-                        data = await response.json()
-                        if not data or 'films' not in data:
-                            logger.error(
-                                f"Invalid response format for page {page}")
-                            continue
-
-                        movies = data.get('films', [])
-                        if not movies:
-                            logger.error(f"No movies found on page {page}")
-                            continue
-
-                        all_movies.extend(movies)
-                        logger.info(
-                            f"Got {len(movies)} movies from page {page}")
-
-                logger.info(
-                    f"Total movies collected from API: {len(all_movies)}")
-                return all_movies
+            for page, movies in enumerate(pages, start=1):
+                if isinstance(movies, Exception):
+                    logger.error(
+                        f"Error getting top movies page {page}: {str(movies)}")
+                    continue
+                all_movies.extend(movies)
 
-            except Exception as e:
-                logger.error(
-                    f"Error getting top 250 movies from API: {str(e)}", exc_info=True)
-                return []
+            logger.info(
+                f"Total movies collected from API: {len(all_movies)}")
+            return all_movies
+
+        except Exception as e:
+            logger.error(
+                f"Error getting top 250 movies from API: {str(e)}", exc_info=True)
+            return []
 
     async def _update_top250_cache(self) -> None:
         """Обновляет кэш топ-250 фильмов"""
         logger.info("Updating top 250 movies cache...")
-        self._top250_cache = await self._fetch_top250_from_api()
-        self._cache_timestamp = datetime.now().timestamp()
+        films = await self._fetch_top250_from_api()
+        if not films:
+            # Запоминаем неудачную попытку, чтобы при недоступном API
+            # повторять обновление не чаще раза в _retry_interval
+            self._cache_timestamp = (
+                time.monotonic() - self._cache_duration + self._retry_interval)
+            if self._top250_cache:
+                logger.error(
+                    "Got no top 250 movies from API, keeping the previous cache")
+            else:
+                logger.error("Got no top 250 movies from API")
+                self._top250_cache = []
+                self._top250_details_cache = []
+            return
+
+        # Сразу загружаем детали фильмов, чтобы игра выбирала их из памяти
+        details = await asyncio.gather(
+            *(self._get_movie_details(movie['filmId']) for movie in films),
+            return_exceptions=True)
+
+        # Кэш публикуется целиком только после загрузки деталей: иначе
+        # вызовы во время прогрева увидят список без пула для игры
+        # и запустят второе обновление
+        self._top250_details_cache = [
+            movie_info for movie_info in details
+            if isinstance(movie_info, MovieInfo) and movie_info.overview
+        ]
+        self._top250_cache = films
+        self._cache_timestamp = time.monotonic()
         logger.info(
-            f"Cache updated with {len(self._top250_cache) if self._top250_cache else 0} movies")
+            f"Cache updated with {len(self._top250_cache) if self._top250_cache else 0} movies, "
+            f"{len(self._top250_details_cache)} with descriptions")
+
+        if self._top250_cache:
+            try:
+                await asyncio.to_thread(self._save_top250_to_disk)
+            except Exception as e:
+                logger.error(f"Error saving top 250 cache to disk: {str(e)}")
+
+    def _is_top250_cache_fresh(self) -> bool:
+        return (self._top250_cache is not None and
+                self._cache_timestamp is not None and
+                time.monotonic() - self._cache_timestamp <= self._cache_duration)
 
     async def get_top250_movies(self) -> List[Dict]:
         """Получает список топ-250 фильмов, используя кэш если он актуален"""
-        current_time = datetime.now().timestamp()
-
-        # Если кэш пустой или устарел, обновляем его
-        if (self._top250_cache is None or
-            self._cache_timestamp is None or
-                current_time - self._cache_timestamp > self._cache_duration):
-            await self._update_top250_cache()
+        if self._top250_cache is None:
+            # Кэша еще нет: загружает только одна задача, остальные ждут
+            # блокировку и читают уже заполненный кэш
+            async with self._refresh_lock:
+                if self._top250_cache is None:
+                    await self._update_top250_cache()
+        elif not self._is_top250_cache_fresh() and self._refresh_task is None:
+            # Кэш устарел: отдаем его сразу, а обновляем в фоне
+            self._refresh_task = asyncio.create_task(self._background_refresh())
 
         return self._top250_cache or []
 
-    async def search_movie(self, query: str) -> List[MovieInfo]:
-        async with aiohttp.ClientSession() as session:
-            headers = {
-                'X-API-KEY': self.api_key,
-                'Content-Type': 'application/json'
-            }
-
-            params = {
-                'keyword': query
-            }
+    async def _background_refresh(self) -> None:
+        try:
+            async with self._refresh_lock:
+                await self._update_top250_cache()
+        except Exception as e:
+            logger.error(
+                f"Error refreshing top 250 cache: {str(e)}", exc_info=True)
+        finally:
+            self._refresh_task = None
 
-            async with session.get(self.search_url, headers=headers, params=params) as response:
-                if response.status != 200:
-                    return []
+    async def search_movie(self, query: str) -> List[MovieInfo]:
+        """Ищет фильмы по названию, повторные запросы отдаются из кэша"""
+        cache_key = query.strip().lower()
+        movies = self._search_cache.get(cache_key)
+        if movies is None:
+            movies = await self._search_movie_from_api(query)
+            # Пустой ответ может быть временной ошибкой API, его не кэшируем
+            if movies:
+                self._search_cache[cache_key] = movies
+        return movies
+
+    async def _search_movie_from_api(self, query: str) -> List[MovieInfo]:
+        session = await self._get_session()
+
+        params = {
+            'keyword': query
+        }
+
+        async with session.get(self.search_url, params=params) as response:
+            if response.status != 200:
+                return []
 
-                data = await response.json()
-                movies = []
-                for movie in data.get('films', [])[:5]:
-                    movie_info = await self._get_movie_details(movie['filmId'])
-                    if movie_info:
-                        movies.append(movie_info)
+            data = orjson.loads(await response.read())
 
-                return movies
+        # Детали найденных фильмов загружаем параллельно
+        movie_ids = [movie['filmId'] for movie in data.get('films', [])[:5]]
+        details = await asyncio.gather(
+            *(self._get_movie_details(movie_id) for movie_id in movie_ids))
+        return [movie_info for movie_info in details if movie_info]
 
     async def random_movie(self) -> List[MovieInfo]:
         try:
@@ -130,135 +322,86 @@ class MovieSearcher:
             top_movies = await self.get_top250_movies()
             if not top_movies:
                 return []
-            shuffle(top_movies)
 
-            # Выбираем случайный фильм из списка
-            random_movie = top_movies[0]
+            # Выбираем случайный фильм из списка, не перемешивая общий кэш
+            random_movie = choice(top_movies)
             movie_id = random_movie['filmId']
 
-            # Получаем детальную информацию о фильме
-            async with aiohttp.ClientSession() as session:
-                headers = {
-                    'X-API-KEY': self.api_key,
-                    'Content-Type': 'application/json'
-                }
-
-                async with session.get(f"{self.movie_url}/{movie_id}", headers=headers) as response:
-                    if response.status != 200:
-                        return []
-
-                    data = await response.json()
-                    genres = [genre['genre']
-                              for genre in data.get('genres', [])]
-                    countries = [country['country']
-                                 for country in data.get('countries', [])]
-
-                    viewing_links = [
-                        f"https://www.kinopoisk.vip/film/{movie_id}/"
-                    ]
-
-                    rating_str = data.get('ratingKinopoisk', '0')
-                    try:
-                        rating = float(rating_str)
-                    except:
-                        rating = 0.0
-
-                    return [MovieInfo(
-                        title=data.get('nameRu', '') or data.get(
-                            'nameEn', '') or data.get('nameOriginal', ''),
-                        overview=data.get('description', '')[
-                            :150] + '...' if data.get('description', '') else '',
-                        rating=rating,
-                        poster_url=data.get('posterUrl', ''),
-                        release_date=data.get('year', ''),
-                        movie_id=str(movie_id),
-                        viewing_links=viewing_links,
-                        genres=genres,
-                        countries=countries,
-                        film_length=data.get('filmLength', '')
-                    )]
+            # Получаем детальную информацию о фильме (обычно уже из кэша)
+            movie_info = await self._get_movie_details(movie_id)
+            return [movie_info] if movie_info else []
         except Exception as e:
             logger.error(
                 f"Error getting random movie: {str(e)}", exc_info=True)
             return []
 
     async def _get_movie_details(self, movie_id: int) -> Optional[MovieInfo]:
-        async with aiohttp.ClientSession() as session:
-            headers = {
-                'X-API-KEY': self.api_key,
-                'Content-Type': 'application/json'
-            }
-
-            async with session.get(f"{self.movie_url}/{movie_id}", headers=headers) as response:
-                if response.status != 200:
-                    return None
-
-                data = await response.json()
-
-                genres = [genre['genre'] for genre in data.get('genres', [])]
-                countries = [country['country']
-                             for country in data.get('countries', [])]
-
-                viewing_links = [
-                    f"https://www.kinopoisk.vip/film/{movie_id}/"
-                ]
-
-                rating_str = data.get('ratingKinopoisk', '0')
-                try:
-                    rating = float(rating_str)
-                except:
-                    rating = 0.0
-
-                return MovieInfo(
-                    title=data.get('nameRu', '') or data.get(
-                        'nameEn', '') or data.get('nameOriginal', ''),
-                    overview=data.get('description', '')[
-                        :150] + '...' if data.get('description', '') else '',
-                    rating=rating,
-                    poster_url=data.get('posterUrl', ''),
-                    release_date=data.get('year', ''),
-                    movie_id=str(movie_id),
-                    viewing_links=viewing_links,
-                    genres=genres,
-                    countries=countries,
-                    film_length=data.get('filmLength', '')
-                )
+        """Возвращает информацию о фильме, используя кэш если она уже загружалась"""
+        movie_info = self._details_cache.get(movie_id)
+        if movie_info is None:
+            movie_info = await self._fetch_movie_details(movie_id)
+            if movie_info:
+                self._details_cache[movie_id] = movie_info
+        return movie_info
+
+    async def _fetch_movie_details(self, movie_id: int) -> Optional[MovieInfo]:
+        session = await self._get_session()
+
+        async with self._semaphore, session.get(f"{self.movie_url}/{movie_id}") as response:
+            if response.status != 200:
+                return None
+
+            data = orjson.loads(await response.read())
+            return self._parse_movie_info(movie_id, data)
+
+    def _parse_movie_info(self, movie_id: int, data: Dict) -> MovieInfo:
+        """Собирает MovieInfo из ответа API с деталями фильма"""
+        title = data.get('nameRu') or data.get('nameEn') or data.get('nameOriginal') or ''
+        description = data.get('description') or ''
+        overview = description[:150] + '...' if description else ''
+
+        genres = tuple(genre['genre'] for genre in data.get('genres', []))
+        countries = tuple(country['country']
+                          for country in data.get('countries', []))
+
+        # Рейтинг приходит числом, строкой или null
+        try:
+            rating = float(data.get('ratingKinopoisk') or 0)
+        except (TypeError, ValueError):
+            rating = 0.0
+
+        return MovieInfo(
+            title=title,
+            overview=overview,
+            rating=rating,
+            poster_url=data.get('posterUrl', ''),
+            release_date=data.get('year', ''),
+            movie_id=str(movie_id),
+            genres=genres,
+            countries=countries,
+            film_length=data.get('filmLength', '')
+        )
 
     async def get_random_movies_for_game(self, count: int = 4) -> List[MovieInfo]:
-        """Get random movies for the game, ensuring they have descriptions"""
+        """Get up to count random movies for the game, ensuring they have descriptions"""
         try:
-            logger.info("Getting top 250 movies for game...")
-            # Получаем список топ-250 фильмов
-            top_movies = await self.get_top250_movies()
-            if not top_movies:
-                logger.error("No top 250 movies found")
-                return []
-            shuffle(top_movies)
-
-            logger.info(f"Found {len(top_movies)} top movies")
-            # Фильтруем фильмы, у которых есть описание
-            movies_with_description = []
-            for movie in top_movies:
-                movie_info = await self._get_movie_details(movie['filmId'])
-                if movie_info and movie_info.overview:
-                    movies_with_description.append(movie_info)
-                    logger.info(
-                        f"Added movie with description: {movie_info.title}")
-                # Берем в 2 раза больше для разнообразия
-                if len(movies_with_description) >= count * 3:
-                    break
-
-            logger.info(
-                f"Found {len(movies_with_description)} movies with descriptions")
-            # Выбираем случайные фильмы
+            logger.debug("Getting top 250 movies for game...")
+            # Пул фильмов с описаниями обновляется вместе с кэшем топ-250
+            await self.get_top250_movies()
+            movies_with_description = self._top250_details_cache or []
+
+            logger.debug("Found %d movies with descriptions",
+                         len(movies_with_description))
+            # Выбираем случайные фильмы; если пул прогрелся не полностью,
+            # отдаем сколько есть, а минимум для игры проверяет вызывающий код
             if len(movies_with_description) < count:
-                logger.error(
-                    f"Not enough movies with descriptions. Found: {len(movies_with_description)}, needed: {count}")
-                return []
+                logger.warning(
+                    f"Not enough movies with descriptions. Found: {len(movies_with_description)}, requested: {count}")
 
-            selected_movies = sample(movies_with_description, count)
-            logger.info(
-                f"Selected {len(selected_movies)} random movies for game")
+            selected_movies = sample(
+                movies_with_description, min(count, len(movies_with_description)))
+            logger.debug("Selected %d random movies for game",
+                         len(selected_movies))
             return selected_movies
         except Exception as e:
             logger.error(
@@ -268,6 +411,7 @@ class MovieSearcher:
     def get_movie_description_for_game(self, movie: MovieInfo) -> str:
         """Get a game-appropriate description of the movie"""
         description = movie.overview
-        # Убираем название фильма из описания, если оно там есть
-        description = description.replace(movie.title, "***")
-        return description
+        if not movie.title:
+            return description
+        # Убираем название фильма из описания в любом регистре
+        return _title_pattern(movie.title).sub("***", description)